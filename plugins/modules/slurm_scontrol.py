@@ -9,8 +9,14 @@
 # Module to interact with slurm controller using scontrol
 
 from __future__ import (absolute_import, division, print_function)
+import json
+import os
+import re
+import shlex
+import subprocess
+import tempfile
+import time
 from ansible.module_utils.basic import AnsibleModule
-from ansible.module_utils.common import yaml
 
 DOCUMENTATION = r"""
 ---
@@ -41,6 +47,14 @@ options:
             - eg. 'node maintenance'
         required: false
         type: str
+    refresh_after_update:
+        description:
+            - If true, node states are read back from scontrol after the update.
+            - If false, returned data is derived from the pre-update state,
+            - saving one scontrol round-trip.
+        required: false
+        type: bool
+        default: false
 """
 
 EXAMPLES = r"""
@@ -80,6 +94,10 @@ scontrol_commands:
     description: List of scontrol commands used to change state of target node
     type: list
     returned: always
+updated_nodes:
+    description: List of nodes whose state or reason was changed by module
+    type: list
+    returned: always
 scontrol_update_ran:
     description: If scontrol update command was ran by module
     type: bool
@@ -88,31 +106,31 @@ scontrol_update_ran:
 
 
 # constants:
-NODE_ALLOWED_STATES=['DOWN','DRAIN','FAIL','FUTURE','NORESP',\
-    'POWER_DOWN','POWER_DOWN_ASAP','POWER_DOWN_FORCE','POWER_UP','RESUME','UNDRAIN']
+NODE_ALLOWED_STATES=frozenset({'DOWN','DRAIN','FAIL','FUTURE','NORESP',\
+    'POWER_DOWN','POWER_DOWN_ASAP','POWER_DOWN_FORCE','POWER_UP','RESUME','UNDRAIN'})
+
+STATES_NEED_REASON=frozenset({'DRAIN'})
 
-STATES_NEED_REASON=['DRAIN']
+# transitions whose outcome is known without re-asking scontrol:
+LOCALLY_DERIVABLE_STATES=frozenset({'DRAIN','RESUME','UNDRAIN'})
 
-def sanitize_input(module,result):
+# seconds the cached chaining capability stays valid across delegated invocations:
+CHAINING_CACHE_TTL=60
+
+def sanitize_input(module,result,nodes,new_state,new_state_reason):
     """Sanitization of module arguments"""
 
     # verify if state is allowed
-    if (
-        ( module.params['new_state'] ) and
-        ( str(module.params['new_state']).upper() not in NODE_ALLOWED_STATES )
-    ):
-        module.fail_json(msg=f"new_state is not in {NODE_ALLOWED_STATES}", **result)
+    if new_state and new_state not in NODE_ALLOWED_STATES:
+        module.fail_json(msg=f"new_state is not in {sorted(NODE_ALLOWED_STATES)}", **result)
 
     # if draining, we need Reason
-    if (
-        ( str(module.params['new_state']).upper() in STATES_NEED_REASON ) and
-        ( module.params['new_state_reason'] is None )
-    ):
-        module.fail_json(msg=f"If next state is in {STATES_NEED_REASON}, \
+    if new_state in STATES_NEED_REASON and not new_state_reason:
+        module.fail_json(msg=f"If next state is in {sorted(STATES_NEED_REASON)}, \
             we need 'new_state_reason' argument to be specified.", **result)
 
     # we need at least one node
-    if not len(module.params['nodes']) > 0:
+    if not nodes:
         module.fail_json(msg="No nodes provided, that's unexpeted.", **result)
 
 
@@ -134,6 +152,11 @@ def run_module():
             "type": str,
             "required": False,
             "default": None
+        },
+        "refresh_after_update": {
+            "type": bool,
+            "required": False,
+            "default": False
         }
     }
 
@@ -143,6 +166,7 @@ def run_module():
         'state_changed': False,
         'reason_changed': False,
         'scontrol_commands': [],
+        'updated_nodes': [],
         'data': '',
         'scontrol_update_ran': False
     }
@@ -152,48 +176,65 @@ def run_module():
         supports_check_mode=True
     )
 
-    # Sanity checking:
-    sanitize_input(module,result)
+    # normalize arguments used on the hot paths once;
+    # the immutable tuple avoids repeated module.params lookups:
+    nodes = tuple(module.params['nodes'] or ())
+    new_state = (module.params['new_state'] or '').upper() or None
+    new_state_reason = module.params['new_state_reason']
 
-    # verify if slurm controller is alive
-    scontrol_ping(module)
+    # Sanity checking:
+    sanitize_input(module,result,nodes,new_state,new_state_reason)
 
-    nodes = module.params['nodes']
+    # read-only dry run has nothing to predict, skip all subprocesses:
+    if module.check_mode and not new_state:
+        module.exit_json( \
+            msg="check mode without new_state: no scontrol queries executed", **result)
 
-    nodes_1 = collect_nodes_status(nodes,module)
+    # no update is issued in check mode, so there is nothing to refresh either:
+    refresh_after_update = module.params['refresh_after_update'] and not module.check_mode
 
-    if module.params['new_state']:
+    # when the returned data comes from a fresh post-update fetch anyway,
+    # the cheap one-line read is enough for change detection;
+    # an unreachable controller surfaces here either way, no separate ping needed:
+    if new_state and refresh_after_update:
+        nodes_1 = collect_nodes_status_oneline(nodes,module,result)
+    else:
+        nodes_1 = collect_nodes_status(nodes,module,result)
 
-        new_state = str(module.params['new_state']).upper()
-        new_state_reason = str(module.params['new_state_reason'])
+    nodes_2 = None
 
-        for node in nodes:
+    if new_state:
 
-            result['state_changed'] = \
-                new_state not in nodes_1[node]['state']
-            result['reason_changed'] = \
-                not new_state_reason == nodes_1[node]['reason']
+        result['state_changed'], result['reason_changed'], result['updated_nodes'] = \
+            detect_pending_updates(nodes,nodes_1,new_state,new_state_reason)
 
-            # If the node is already drained and reason is same, no need to do anything
-            if not result['state_changed'] and not result['reason_changed']:
-                continue
+        # all nodes share the same (state,reason) transition,
+        # so one hostlist-expression update is enough:
+        if result['updated_nodes']:
 
             result['scontrol_update_ran'] = True
 
-            scontrol_command = \
-                f"scontrol update node={node} state={new_state} reason=\"{new_state_reason}\""
-            result['scontrol_commands'].append(scontrol_command)
+            hostlist = compress_hostlist(result['updated_nodes'])
+            # argv form needs no shell parsing and is safe against quotes in reason:
+            scontrol_command = ['scontrol', 'update', f"node={hostlist}", f"state={new_state}"]
+            if new_state_reason is not None:
+                scontrol_command.append(f"reason={new_state_reason}")
+            result['scontrol_commands'].append(shlex.join(scontrol_command))
             if not module.check_mode:
-                res = module.run_command(scontrol_command)
-                if res[0] != 0:
-                    module.fail_json( \
-                        msg=f"Calling {scontrol_command} returned non-zero RC", \
-                        **result)
-
-    if result['scontrol_update_ran']:
-        nodes_2 = collect_nodes_status(nodes,module)
+                nodes_2 = run_update(nodes,module,result,scontrol_command,refresh_after_update)
+
+    if new_state and refresh_after_update:
+        if nodes_2 is None:
+            nodes_2 = collect_nodes_status(nodes,module,result)
         result['data'] = nodes_2
+    elif result['scontrol_update_ran'] and not module.check_mode \
+            and new_state not in LOCALLY_DERIVABLE_STATES:
+        # the outcome of eg. DOWN or POWER_* transitions cannot be derived
+        # locally, read the real state back even without refresh_after_update:
+        result['data'] = collect_nodes_status(nodes,module,result)
     else:
+        # post-update state of the touched fields is known without re-asking scontrol:
+        apply_updates_locally(nodes_1,result['updated_nodes'],new_state,new_state_reason)
         result['data'] = nodes_1
 
     #compile informations if changed:
@@ -202,23 +243,299 @@ def run_module():
     module.exit_json(**result)
 
 
-def scontrol_ping(module):
-    """" Tests if we have working scontrol"""
+def as_state_set(state):
+    """ Convert scontrol node state (list of flags or 'A+B' string) into a frozenset"""
+
+    if isinstance(state, list):
+        return frozenset(state)
+    return frozenset(str(state).split('+'))
+
+
+def set_node_entry_state(entry,state_set):
+    """ Replace the state set of a cached node entry, keeping state_raw in sync"""
+
+    raw_is_list = isinstance(entry['state_raw'], list)
+    original = entry['state_raw'] if raw_is_list else str(entry['state_raw']).split('+')
+    flags = [flag for flag in original if flag in state_set]
+    flags += [flag for flag in sorted(state_set) if flag not in original]
+    entry['state'] = frozenset(state_set)
+    entry['state_raw'] = flags if raw_is_list else '+'.join(flags)
+
+
+def apply_updates_locally(nodes_status,updated_nodes,new_state,new_state_reason):
+    """ Patch cached node entries to reflect a successful update without re-asking
+        scontrol; covers only the transitions with locally known outcome - DRAIN
+        adds the flag and the reason, UNDRAIN drops the flag, RESUME drops the
+        failure flags and clears the reason"""
+
+    for node in updated_nodes:
+        entry = nodes_status[node]
+        if new_state == 'DRAIN':
+            set_node_entry_state(entry, entry['state'] | {'DRAIN'})
+            entry['reason'] = new_state_reason
+        elif new_state == 'UNDRAIN':
+            set_node_entry_state(entry, entry['state'] - {'DRAIN'})
+        elif new_state == 'RESUME':
+            set_node_entry_state(entry, entry['state'] - {'DRAIN', 'DOWN', 'FAIL'})
+            entry['reason'] = ''
+
 
-    scontrol_command = "scontrol ping"
-    module.run_command(scontrol_command)
+def detect_pending_updates(nodes,nodes_status,new_state,new_state_reason):
+    """ Single pass over nodes returning change flags and the list of nodes needing update"""
 
-def collect_nodes_status(nodes,module):
-    """ Run `scontrol show status` over nodes and returns it as a dict"""
+    state_changed = False
+    reason_changed = False
+    nodes_to_update = []
+
+    # nodes already in requested state with same reason need no update;
+    # without new_state_reason the update leaves the stored reason alone,
+    # so a None reason must not count as a difference or the module would
+    # re-issue the same no-op update forever:
+    for node in nodes:
+        node_state_differs = new_state not in nodes_status[node]['state']
+        node_reason_differs = new_state_reason is not None \
+            and new_state_reason != nodes_status[node]['reason']
+        state_changed = state_changed or node_state_differs
+        reason_changed = reason_changed or node_reason_differs
+        if node_state_differs or node_reason_differs:
+            nodes_to_update.append(node)
+
+    return state_changed, reason_changed, nodes_to_update
+
+
+def collect_nodes_status_oneline(nodes,module,result):
+    """ Fast path reading only state+reason from one-line `scontrol -o show node` output"""
 
     nodes_data = {}
 
+    scontrol_command = ['scontrol', '-o', 'show', 'node=' + ','.join(nodes)]
+    scontrol_out = subprocess.run(scontrol_command, capture_output=True, text=True, check=False)
+    if scontrol_out.returncode != 0:
+        module.fail_json( \
+            msg=f"Calling {' '.join(scontrol_command)} returned non-zero RC: " \
+                f"{scontrol_out.stderr}", \
+            **result)
+
+    for line in scontrol_out.stdout.splitlines():
+        if not line.strip():
+            continue
+        # Reason is printed last and may contain spaces, so cut it off first;
+        # scontrol appends ' [user@timestamp]' to the stored reason, strip it
+        # so the comparison against new_state_reason can match:
+        reason = ''
+        reason_index = line.find(' Reason=')
+        if reason_index != -1:
+            reason = line[reason_index + len(' Reason='):].strip()
+            reason = re.sub(r'\s*\[[^\[\]]+@[^\[\]]+\]$', '', reason)
+            line = line[:reason_index]
+        tokens = dict(token.split('=', 1) for token in line.split() if '=' in token)
+        if 'NodeName' in tokens:
+            nodes_data[tokens['NodeName']] = {
+                'state': as_state_set(tokens.get('State', '')),
+                'state_raw': tokens.get('State', ''),
+                'reason': reason
+            }
+
+    return nodes_data
+
+
+def compress_hostlist(nodes):
+    """ Compress list of node names into Slurm hostlist expression, eg. n[1-3,5]"""
+
+    numbered = {}
+    expressions = []
+
     for node in nodes:
-        scontrol_command = f"scontrol --yaml show node={node}"
-        scontrol_out = module.run_command(scontrol_command)
+        match = re.fullmatch(r'(\D+)(\d+)', node)
+        if match:
+            # group by prefix and number width to keep zero-padding intact:
+            key = (match.group(1), len(match.group(2)))
+            numbered.setdefault(key, []).append(int(match.group(2)))
+        else:
+            expressions.append(node)
+
+    for (prefix, width), numbers in numbered.items():
+        ranges = []
+        for number in sorted(set(numbers)):
+            if ranges and number == ranges[-1][1] + 1:
+                ranges[-1][1] = number
+            else:
+                ranges.append([number, number])
+        body = ','.join( \
+            f"{start:0{width}d}" if start == end else f"{start:0{width}d}-{end:0{width}d}" \
+            for start, end in ranges)
+        expressions.append(f"{prefix}[{body}]")
+
+    return ','.join(expressions)
+
+
+def get_yaml_loader():
+    """ Import PyYAML lazily and pick the fastest available safe loader"""
+
+    # yaml is needed only when scontrol output is parsed,
+    # deferring the import keeps module startup cheap:
+    import yaml   # pylint: disable=import-outside-toplevel
+    try:
+        from yaml import CSafeLoader as loader   # pylint: disable=import-outside-toplevel
+    except ImportError:
+        from yaml import SafeLoader as loader   # pylint: disable=import-outside-toplevel
+    return yaml, loader
+
+
+def chaining_cache_path():
+    """ Per-user cache file shared by repeated delegated invocations on one host"""
+
+    runtime_dir = f"/run/user/{os.getuid()}"
+    base_dir = runtime_dir if os.path.isdir(runtime_dir) else tempfile.gettempdir()
+    return os.path.join(base_dir, f"ansible_slurm_scontrol_{os.getuid()}.json")
+
+
+def read_cached_chaining_support():
+    """ Return the cached chaining capability, or None when the cache is missing or stale"""
+
+    try:
+        # O_NOFOLLOW refuses symlinks a local user may have planted in the
+        # shared tmpdir fallback:
+        descriptor = os.open(chaining_cache_path(), os.O_RDONLY | os.O_NOFOLLOW)
+        with os.fdopen(descriptor, encoding='utf-8') as cache_file:
+            cached = json.load(cache_file)
+        if time.time() - cached['ts'] <= CHAINING_CACHE_TTL:
+            return bool(cached['chaining_ok'])
+    except (OSError, ValueError, KeyError):
+        pass
+    return None
+
+
+def write_cached_chaining_support(chaining_ok):
+    """ Best-effort persistence of the chaining capability for the next invocation"""
+
+    try:
+        # O_NOFOLLOW + 0o600 keep the shared tmpdir fallback safe from symlink
+        # planting, a plain open() would happily truncate the link target:
+        descriptor = os.open(chaining_cache_path(), \
+            os.O_WRONLY | os.O_CREAT | os.O_TRUNC | os.O_NOFOLLOW, 0o600)
+        with os.fdopen(descriptor, 'w', encoding='utf-8') as cache_file:
+            json.dump({'chaining_ok': chaining_ok, 'ts': time.time()}, cache_file)
+    except OSError:
+        pass
+
+
+def run_update(nodes,module,result,scontrol_command,refresh_after_update):
+    """ Execute node update, chaining the refreshing show into the same scontrol
+        process when requested and supported; returns fresh node data or None"""
+
+    # the interactive tokenizer cannot carry double quotes or newlines intact,
+    # such values stay on the argv path which passes them through exactly:
+    chainable = not any('"' in token or '\n' in token for token in scontrol_command)
+
+    if refresh_after_update and chainable and read_cached_chaining_support() is not False:
+        nodes_data = scontrol_update_and_show(nodes,scontrol_command)
+        write_cached_chaining_support(nodes_data is not None)
+        if nodes_data is not None:
+            return nodes_data
+
+    res = subprocess.run(scontrol_command, capture_output=True, text=True, check=False)
+    if res.returncode != 0:
+        module.fail_json( \
+            msg=f"Calling {shlex.join(scontrol_command)} returned non-zero RC: {res.stderr}", \
+            **result)
+    return None
+
+
+def quote_scontrol_line(argv):
+    """ Rebuild an argv scontrol command as one line for the interactive tokenizer,
+        double-quoting values with spaces (eg. reason)"""
+
+    tokens = []
+    for token in argv:
+        key, separator, value = token.partition('=')
+        if separator and ' ' in value:
+            token = f'{key}="{value}"'
+        tokens.append(token)
+    return ' '.join(tokens)
+
+
+def scontrol_update_and_show(nodes,scontrol_command):
+    """ Issue update and the follow-up show through one interactive scontrol process,
+        saving a fork+exec; returns parsed node data or None when the session is
+        unsupported or its reply unusable, letting the caller take the two-call path"""
+
+    yaml, yaml_safe_loader = get_yaml_loader()
+
+    session = quote_scontrol_line(scontrol_command[1:]) \
+        + '\nshow node=' + ','.join(nodes) + '\nquit\n'
+
+    proc = subprocess.run(['scontrol', '--yaml'], input=session.encode(), \
+        capture_output=True, check=False)
+    # a Slurm without --yaml or session support bails out before reading stdin,
+    # so the update has not run yet and the plain argv path can take over;
+    # a genuine update failure reproduces (and is reported) there as well:
+    if proc.returncode != 0:
+        return None
+
+    # update prints nothing on success, the show reply is a YAML document:
+    nodes_data = {}
+    for document in proc.stdout.split(b'---'):
+        try:
+            parsed = yaml.load(document, Loader=yaml_safe_loader)
+        except yaml.YAMLError:
+            continue
+        if not isinstance(parsed, dict) or 'nodes' not in parsed:
+            continue
+        for node_entry in parsed['nodes']:
+            node_entry['state_raw'] = node_entry['state']
+            node_entry['state'] = as_state_set(node_entry['state'])
+            nodes_data[node_entry['name']] = node_entry
+
+    # fall back to the separate refresh when any node is missing in the reply:
+    if all(node in nodes_data for node in nodes):
+        return nodes_data
+    return None
+
 
-        scontrol_respond_yaml = yaml.yaml_load(scontrol_out[1])
-        nodes_data[node] = scontrol_respond_yaml['nodes'][0]
+def collect_nodes_status(nodes,module,result):
+    """ Run single batched `scontrol show node` over all nodes and returns it as a dict"""
+
+    yaml, yaml_safe_loader = get_yaml_loader()
+
+    nodes_data = {}
+
+    # subprocess.run skips run_command's per-call env/locale bookkeeping,
+    # stdout stays bytes - libyaml parses those directly without a decode pass:
+    scontrol_command = ['scontrol', '--yaml', 'show', 'node=' + ','.join(nodes)]
+    scontrol_out = subprocess.run(scontrol_command, capture_output=True, check=False)
+    if scontrol_out.returncode != 0:
+        module.fail_json( \
+            msg=f"Calling {' '.join(scontrol_command)} returned non-zero RC: " \
+                f"{scontrol_out.stderr.decode(errors='replace')}", \
+            **result)
+
+    try:
+        scontrol_respond_yaml = yaml.load(scontrol_out.stdout, Loader=yaml_safe_loader)
+        for node_entry in scontrol_respond_yaml['nodes']:
+            node_entry['state_raw'] = node_entry['state']
+            node_entry['state'] = as_state_set(node_entry['state'])
+            nodes_data[node_entry['name']] = node_entry
+    except (yaml.YAMLError, KeyError, TypeError):
+        nodes_data = {}
+
+    # fallback to per-node calls when the batched reply can't be parsed
+    # or some node is missing in it:
+    for node in nodes:
+        if node in nodes_data:
+            continue
+        scontrol_command = ['scontrol', '--yaml', 'show', f"node={node}"]
+        scontrol_out = subprocess.run(scontrol_command, capture_output=True, check=False)
+        if scontrol_out.returncode != 0:
+            module.fail_json( \
+                msg=f"Calling {' '.join(scontrol_command)} returned non-zero RC: " \
+                    f"{scontrol_out.stderr.decode(errors='replace')}", \
+                **result)
+        scontrol_respond_yaml = yaml.load(scontrol_out.stdout, Loader=yaml_safe_loader)
+        node_entry = scontrol_respond_yaml['nodes'][0]
+        node_entry['state_raw'] = node_entry['state']
+        node_entry['state'] = as_state_set(node_entry['state'])
+        nodes_data[node] = node_entry
 
     return nodes_data
 